@@ -10,14 +10,19 @@ def fit_step(side_probabilities, residuals, uncertainties, mask, verbosity=1,
     fit_residuals = residuals[mask]
     fit_uncertainties = uncertainties[mask]
 
+    # These don't depend on the parameters, so compute them once rather than every
+    # time that the likelihood is evaluated.
+    fit_variances = fit_uncertainties**2
+    fit_other_side_probabilities = 1 - fit_side_probabilities
+
     def calc_likelihood(x):
         offset_1, offset_2, dispersion_1, dispersion_2 = x
 
-        var_1 = fit_uncertainties**2 + dispersion_1**2
-        var_2 = fit_uncertainties**2 + dispersion_2**2
+        var_1 = fit_variances + dispersion_1**2
+        var_2 = fit_variances + dispersion_2**2
 
         likelihood = np.sum(-np.log(
-            (1 - fit_side_probabilities) / np.sqrt(2 * np.pi * var_1)
+            fit_other_side_probabilities / np.sqrt(2 * np.pi * var_1)
                 * np.exp(-(fit_residuals - offset_1)**2 / 2. / var_1)
             + fit_side_probabilities / np.sqrt(2 * np.pi * var_2)
                 * np.exp(-(fit_residuals - offset_2)**2 / 2. / var_2)
@@ -101,6 +106,17 @@ def plot_mean(ax, min_x, max_x, mean, mean_uncertainty, color):
     )
 
 
+def _get_host_values(host_data, key):
+    """Return a column of the host data as a plain float array with NaN for missing
+    entries.
+    """
+    column = host_data[key]
+    values = np.array(column, dtype=float)
+    values[np.ma.getmaskarray(column)] = np.nan
+
+    return values
+
+
 def plot_step(variable, residuals, residual_uncertainties, host_data, mask, title=None,
               **kwargs):
     if variable == 'host_lssfr':
@@ -116,10 +132,12 @@ def plot_step(variable, residuals, residual_uncertainties, host_data, mask, titl
     else:
         raise Exception(f"Unknown variable {variable}!")
 
-    host_values = host_data[variable]
-    host_values_down = host_data[variable + '_err_down']
-    host_values_up = host_data[variable + '_err_up']
-    host_probabilities = host_data[probability_tag]
+    # Convert the table columns to plain arrays once rather than going through the
+    # table for every operation.
+    host_values = _get_host_values(host_data, variable)
+    host_values_down = _get_host_values(host_data, variable + '_err_down')
+    host_values_up = _get_host_values(host_data, variable + '_err_up')
+    host_probabilities = _get_host_values(host_data, probability_tag)
 
     step_result = fit_step(host_probabilities, residuals, residual_uncertainties, mask,
                            **kwargs)
@@ -1,29 +1,74 @@
-import george
-from george import kernels
+from joblib import Parallel, delayed
+from scipy.linalg import cho_factor, cho_solve
 from scipy.optimize import minimize
 from matplotlib import pyplot as plt
+from threadpoolctl import threadpool_limits
 import numpy as np
 from idrtools import math
 
 
-def _build_george_gp(coordinates, target_value_uncertainties, parameters):
-    """Build a george Gaussian Process object and kernels."""
-    total_target_value_uncertainties = np.sqrt(
-        target_value_uncertainties**2
-        + parameters[0]**2 * np.ones(len(coordinates))
-    )
+# Variance that george adds to the diagonal of its covariance matrices by default.
+_GEORGE_WHITE_NOISE = 1.25e-12
+
 
-    ndim = coordinates.shape[-1]
-    use_dim = list(range(ndim))
+def _calculate_squared_distances(coordinates_1, coordinates_2):
+    """Calculate the squared distances between two sets of coordinates.
 
-    kernel = parameters[1]**2 * kernels.Matern32Kernel(
-        [parameters[2]**2] * len(use_dim), ndim=ndim, axes=use_dim
+    We use ||a||^2 + ||b||^2 - 2 a.b so that the cross term is a single matrix product
+    and we never build the full array of coordinate differences, which is large for
+    the grids used in the plots.
+    """
+    norms_1 = np.einsum('ij,ij->i', coordinates_1, coordinates_1)
+    norms_2 = np.einsum('ij,ij->i', coordinates_2, coordinates_2)
+    squared_distances = (
+        norms_1[:, None] + norms_2[None, :] - 2 * coordinates_1.dot(coordinates_2.T)
     )
 
-    gp = george.GP(kernel)
-    gp.compute(coordinates, total_target_value_uncertainties)
+    # Roundoff can give slightly negative values for nearly identical coordinates.
+    np.maximum(squared_distances, 0, out=squared_distances)
+
+    return squared_distances
+
+
+def _evaluate_kernel(squared_distances, parameters):
+    """Evaluate the GP kernel for a set of squared distances.
 
-    return gp
+    This is a Matern 3/2 kernel with a single length scale for all dimensions,
+    matching the george kernel `ConstantKernel * Matern32Kernel` that was originally
+    used for this analysis.
+    """
+    # Do the operations in place to avoid allocating a new temporary array for each
+    # step. The input squared distances can be cached, so they are never modified.
+    # Use Python floats for the parameters so that they keep the precision of the
+    # squared distances.
+    scaled_dists = np.multiply(squared_distances, 3 / float(parameters[2])**2)
+    np.sqrt(scaled_dists, out=scaled_dists)
+
+    kernel = np.negative(scaled_dists)
+    np.exp(kernel, out=kernel)
+    scaled_dists += 1
+    kernel *= scaled_dists
+    kernel *= float(parameters[1])**2
+
+    return kernel
+
+
+def _calculate_covariance(squared_distances, target_value_uncertainties, parameters):
+    """Calculate the covariance matrix of the GP for the squared distances between a
+    set of coordinates.
+
+    This includes the measurement uncertainties and intrinsic dispersion on the
+    diagonal, along with the same small white noise term that george adds for
+    numerical stability.
+    """
+    covariance = _evaluate_kernel(squared_distances, parameters)
+    covariance[np.diag_indices_from(covariance)] += (
+        target_value_uncertainties**2
+        + parameters[0]**2
+        + _GEORGE_WHITE_NOISE
+    )
+
+    return covariance
 
 
 class ManifoldGaussianProcess():
@@ -46,6 +91,13 @@ class ManifoldGaussianProcess():
         else:
             self.covariates = np.atleast_2d(covariates)
 
+        # Squared distances between the coordinates of the conditioning sample. These
+        # don't depend on the parameters, so we only calculate them once.
+        self._condition_squared_distances = None
+
+        # Cache of conditioned GPs used for predictions, see _get_conditioned_gp.
+        self._conditioned_gp_cache = {}
+
         # Estimate the fit parameters if none were given.
         if parameters is None:
             self.parameters = self._get_default_parameters()
@@ -101,6 +153,18 @@ class ManifoldGaussianProcess():
     def parameter_dict(self):
         return dict(zip(self.parameter_names, self.parameters))
 
+    def _get_condition_squared_distances(self):
+        """Return the squared distances between the coordinates of the conditioning
+        sample.
+        """
+        if self._condition_squared_distances is None:
+            condition_coordinates = self.coordinates[self.mask]
+            self._condition_squared_distances = _calculate_squared_distances(
+                condition_coordinates, condition_coordinates
+            )
+
+        return self._condition_squared_distances
+
     def _parse_parameters(self, parameters):
         """Parse the parameters list, and return the GP parameters, offset and
         covariate slopes separately
@@ -118,12 +182,6 @@ class ManifoldGaussianProcess():
 
         gp_parameters, offset, covariate_slopes = self._parse_parameters(parameters)
 
-        gp = _build_george_gp(
-            self.coordinates[self.mask],
-            self.target_value_uncertainties[self.mask],
-            gp_parameters
-        )
-
         # Calculate the covariate model for the conditioning dataset.
         model = offset
         if len(covariate_slopes) > 0:
@@ -131,15 +189,63 @@ class ManifoldGaussianProcess():
 
         condition_residuals = (self.target_values - model)[self.mask]
 
-        result = -gp.log_likelihood(condition_residuals)
+        # This is evaluated at every step of the minimizer in fit, so we compute the
+        # likelihood directly from a Cholesky factorization of the covariance matrix
+        # rather than building a new george GP every time, and we reuse the distances
+        # between the conditioning coordinates.
+        covariance = _calculate_covariance(
+            self._get_condition_squared_distances(),
+            self.target_value_uncertainties[self.mask],
+            gp_parameters
+        )
+        factor = cho_factor(covariance)
+        alpha = cho_solve(factor, condition_residuals)
+        log_determinant = 2 * np.sum(np.log(np.diag(factor[0])))
+
+        result = 0.5 * (
+            condition_residuals.dot(alpha)
+            + log_determinant
+            + len(condition_residuals) * np.log(2 * np.pi)
+        )
 
         return result
 
-    def fit(self, cov=True, verbosity=1, options={}, **kwargs):
-        """Fit the parameters to the given dataset"""
+    def _get_restart_parameters(self, initial_parameters, num_restarts):
+        """Draw random starting parameters for restarting the fit.
+
+        The GP hyperparameters are scaled by random factors of up to 3 in either
+        direction, and the offset and covariate slopes start at their initial values.
+        """
+        restart_parameters = []
+        for i in range(num_restarts):
+            parameters = np.array(initial_parameters, dtype=float)
+            parameters[:3] *= np.exp(np.random.uniform(-np.log(3), np.log(3), 3))
+
+            # Make sure that we start within the bounds.
+            for j, (min_bound, max_bound) in enumerate(self.parameter_bounds):
+                if min_bound is not None:
+                    parameters[j] = max(parameters[j], min_bound)
+                if max_bound is not None:
+                    parameters[j] = min(parameters[j], max_bound)
+
+            restart_parameters.append(parameters)
+
+        return restart_parameters
+
+    def fit(self, cov=True, verbosity=1, options={}, num_restarts=0, n_jobs=1,
+            **kwargs):
+        """Fit the parameters to the given dataset
+
+        If num_restarts is greater than 0, the fit is repeated from that many random
+        starting points in addition to the current parameters, and the best result is
+        kept. These fits are run in parallel in n_jobs threads.
+        """
 
         initial_parameters = self.parameters
 
+        # The parameters are about to change, so drop any cached predictions.
+        self._conditioned_gp_cache = {}
+
         if cov:
             # Need a very accurate minimum to be able to measure the covariance since we
             # are using finite differences.
@@ -153,13 +259,39 @@ class ManifoldGaussianProcess():
 
         # For some reason BFGS has some convergence issues with default parameters.
         # Using a small value for ftol fixes this.
-        result = minimize(
-            self.negative_log_likelihood,
-            initial_parameters,
-            bounds=self.parameter_bounds,
-            options=use_options,
-            **kwargs,
-        )
+        def fit_from(start_parameters):
+            return minimize(
+                self.negative_log_likelihood,
+                start_parameters,
+                bounds=self.parameter_bounds,
+                options=use_options,
+                **kwargs,
+            )
+
+        if num_restarts > 0:
+            all_start_parameters = (
+                [initial_parameters]
+                + self._get_restart_parameters(initial_parameters, num_restarts)
+            )
+
+            # Calculate the cached distances before starting any threads.
+            self._get_condition_squared_distances()
+
+            # Each fit is dominated by the Cholesky factorizations which release the
+            # GIL, so threads work well here. Limit BLAS to a single thread in each one
+            # to avoid oversubscribing the CPUs.
+            with threadpool_limits(limits=1, user_api='blas'):
+                all_results = Parallel(n_jobs=n_jobs, prefer='threads')(
+                    delayed(fit_from)(i) for i in all_start_parameters
+                )
+
+            result = min(all_results, key=lambda x: x.fun)
+
+            if verbosity >= 2:
+                print(f"Best fit from {len(all_results)} starts: "
+                      f"{', '.join(f'{i.fun:.3f}' for i in all_results)}")
+        else:
+            result = fit_from(initial_parameters)
 
         self.fit_result = result
         self.parameters = result.x
@@ -233,9 +365,105 @@ class ManifoldGaussianProcess():
 
         return model
 
+    def _get_conditioned_gp(self, parameters, mask):
+        """Condition the GP on the data selected by a mask.
+
+        The factorization of the covariance matrix is cached so that repeated
+        predictions with the same parameters and mask only need to evaluate the kernel
+        at the new coordinates.
+
+        Returns
+        -------
+        condition_coordinates : numpy.array
+            The coordinates of the conditioning data.
+        factor : tuple
+            The Cholesky factorization of the covariance matrix of the conditioning data
+            as returned by `scipy.linalg.cho_factor`.
+        alpha : numpy.array
+            The inverse of the covariance matrix applied to the residuals of the
+            conditioning data.
+        """
+        conditioned_gp = self._get_conditioned_gp_entry(parameters, mask)
+
+        return (conditioned_gp['condition_coordinates'], conditioned_gp['factor'],
+                conditioned_gp['alpha'])
+
+    def _get_inverse_covariance(self, parameters, mask):
+        """Return the inverse of the covariance matrix of the conditioning data.
+
+        This is only needed for prediction uncertainties and out-of-sample
+        predictions, so it is calculated the first time that it is requested and then
+        cached along with the factorization.
+        """
+        conditioned_gp = self._get_conditioned_gp_entry(parameters, mask)
+
+        if conditioned_gp['inverse_covariance'] is None:
+            factor = conditioned_gp['factor']
+            conditioned_gp['inverse_covariance'] = cho_solve(
+                factor, np.eye(len(factor[0]))
+            )
+
+        return conditioned_gp['inverse_covariance']
+
+    def _get_conditioned_gp_entry(self, parameters, mask):
+        """Return the cache entry for the GP conditioned on the data selected by a
+        mask, conditioning it if necessary.
+        """
+        cache_key = (tuple(np.asarray(parameters, dtype=float)), mask.tobytes())
+
+        if cache_key not in self._conditioned_gp_cache:
+            gp_parameters, offset, covariate_slopes = self._parse_parameters(parameters)
+
+            condition_coordinates = self.coordinates[mask]
+            if np.array_equal(mask, self.mask):
+                squared_distances = self._get_condition_squared_distances()
+            else:
+                squared_distances = _calculate_squared_distances(
+                    condition_coordinates, condition_coordinates
+                )
+            covariance = _calculate_covariance(
+                squared_distances,
+                self.target_value_uncertainties[mask],
+                gp_parameters
+            )
+            factor = cho_factor(covariance)
+
+            # Calculate the covariate model for the conditioning dataset, and subtract
+            # it out to get the model residuals.
+            model = self._calculate_covariate_model(self.covariates, parameters)
+            condition_residuals = (self.target_values - model)[mask]
+            alpha = cho_solve(factor, condition_residuals)
+
+            # The inverse of the covariance matrix is filled in by
+            # _get_inverse_covariance when it is needed.
+            self._conditioned_gp_cache[cache_key] = {
+                'condition_coordinates': condition_coordinates,
+                'factor': factor,
+                'alpha': alpha,
+                'inverse_covariance': None,
+            }
+
+        return self._conditioned_gp_cache[cache_key]
+
     def predict(self, prediction_coordinates, prediction_covariates=None,
-                parameters=None, mask=None, return_uncertainties=True):
-        """Predict a Gaussian Process on the given data."""
+                parameters=None, mask=None, return_uncertainties=True,
+                low_precision=False):
+        """Predict a Gaussian Process on the given data.
+
+        If low_precision is True, the kernel between the prediction coordinates and the
+        conditioning data is evaluated in single precision. This is much faster for
+        large grids such as the ones used for plots. The conditioning covariance and
+        its factorization are always evaluated in double precision. The prediction
+        uncertainties are sensitive to roundoff, so they aren't available in this mode.
+        """
+        if low_precision and return_uncertainties:
+            raise ValueError("Uncertainties can't be calculated with low_precision.")
+
+        if low_precision:
+            kernel_dtype = np.float32
+        else:
+            kernel_dtype = np.float64
+
         if parameters is None:
             parameters = self.parameters
 
@@ -247,26 +475,27 @@ class ManifoldGaussianProcess():
 
         gp_parameters, offset, covariate_slopes = self._parse_parameters(parameters)
 
-        gp = _build_george_gp(
-            self.coordinates[mask],
-            self.target_value_uncertainties[mask],
-            gp_parameters
-        )
+        condition_coordinates, factor, alpha = self._get_conditioned_gp(parameters,
+                                                                        mask)
 
-        # Calculate the covariate model for the conditioning dataset, and subtract it
-        # out to get the model residuals.
-        model = self._calculate_covariate_model(self.covariates, parameters)
-        condition_residuals = (self.target_values - model)[mask]
-
-        predictions = gp.predict(
-            condition_residuals,
-            np.atleast_2d(prediction_coordinates),
-            return_cov=False,
-            return_var=return_uncertainties,
+        prediction_kernel = _evaluate_kernel(
+            _calculate_squared_distances(
+                np.atleast_2d(prediction_coordinates).astype(kernel_dtype, copy=False),
+                condition_coordinates.astype(kernel_dtype, copy=False),
+            ),
+            gp_parameters
         )
+        predictions = prediction_kernel.dot(alpha.astype(kernel_dtype, copy=False))
+        predictions = predictions.astype(np.float64, copy=False)
 
         if return_uncertainties:
-            predictions, prediction_variances = predictions
+            # The kernel evaluated at zero distance is just the squared amplitude. The
+            # inverse covariance lets us do this with matrix products rather than
+            # triangular solves.
+            inverse_covariance = self._get_inverse_covariance(parameters, mask)
+            prediction_variances = gp_parameters[1]**2 - np.einsum(
+                'ij,ij->i', prediction_kernel, prediction_kernel.dot(inverse_covariance)
+            )
             prediction_uncertainties = np.sqrt(prediction_variances)
 
         # Add the covariate model back in to the predictions.
@@ -290,26 +519,34 @@ class ManifoldGaussianProcess():
         predictions = np.zeros(len(self.target_values))
         prediction_uncertainties = np.zeros(len(self.target_values))
 
-        # Do out-of-sample predictions for data in the conditioning sample.
-        locs = np.where(self.mask)[0]
-        for loc in locs:
-            oos_mask = np.zeros(len(self.target_values), dtype=bool)
-            oos_mask[loc] = True
-
-            if self.covariates is not None:
-                use_covariates = self.covariates[:, oos_mask]
-            else:
-                use_covariates = None
+        # Do out-of-sample predictions for data in the conditioning sample. Rather than
+        # conditioning a new GP for every left out entry, we use the closed form
+        # leave-one-out predictions (Rasmussen & Williams 2006, section 5.4.2) which
+        # only require a single factorization of the covariance matrix. That
+        # factorization is shared with the in-sample predictions below.
+        gp_parameters, offset, covariate_slopes = self._parse_parameters(
+            self.parameters
+        )
+        condition_variances = (
+            self.target_value_uncertainties[self.mask]**2
+            + gp_parameters[0]**2
+            + _GEORGE_WHITE_NOISE
+        )
 
-            prediction, prediction_uncertainty = self.predict(
-                self.coordinates[oos_mask],
-                use_covariates,
-                mask=~oos_mask,
-                return_uncertainties=True,
-            )
+        condition_coordinates, factor, alpha = self._get_conditioned_gp(
+            self.parameters, self.mask
+        )
+        inverse_covariance_diagonal = np.diag(
+            self._get_inverse_covariance(self.parameters, self.mask)
+        )
 
-            predictions[oos_mask] = prediction
-            prediction_uncertainties[oos_mask] = prediction_uncertainty
+        predictions[self.mask] = (
+            self.target_values[self.mask]
+            - alpha / inverse_covariance_diagonal
+        )
+        prediction_uncertainties[self.mask] = np.sqrt(
+            1 / inverse_covariance_diagonal - condition_variances
+        )
 
         if self.covariates is not None:
             use_covariates = self.covariates[:, ~self.mask]
@@ -375,7 +612,8 @@ class ManifoldGaussianProcess():
             plot_coords[:, axis_y] = flat_plot_y
 
             # Predict the GP residuals over the manifold without covariates.
-            predictions = self.predict(plot_coords, return_uncertainties=False)
+            predictions = self.predict(plot_coords, return_uncertainties=False,
+                                       low_precision=True)
             predictions -= self.parameter_dict['offset']
             predictions -= zeropoint
             predictions = predictions.reshape(plot_x.shape)
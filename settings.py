@@ -50,6 +50,12 @@ default_settings = {
     "isomap_num_neighbors": 10,
     "isomap_num_components": 3,
 
+    # Eigensolver to use for Isomap. This is passed directly to sklearn. "arpack"
+    # only solves for the leading eigenvectors which is much faster than a full dense
+    # decomposition for large samples, but the signs of the components that it
+    # returns are not guaranteed to match the dense solver.
+    "isomap_eigen_solver": "auto",
+
     # The signs of Isomap components are arbitrary. Choose to flip some of them so that
     # they match up nicely with previously established observables.
     "isomap_flip_components": [1],
@@ -57,6 +63,12 @@ default_settings = {
     # Peculiar velocity (in km/s)
     "peculiar_velocity": 300,
 
+    # Number of random restarts to do when fitting the GP hyperparameters in addition
+    # to the fit from the default starting point, and the number of parallel threads to
+    # run the fits in (-1 uses all cores).
+    "gp_num_restarts": 0,
+    "gp_num_jobs": -1,
+
     # Figure parameters
 
     # Directory to save figures to
@@ -47,6 +47,25 @@ def wave_space(vel, lam0):
     return lam
 
 
+def spline_smooth(wave, flux, var, smoothed_wave):
+    """
+    Smooth a spectrum using a spline weighted by the variance
+
+    Args:
+        wave: wavelength the spectrum is observed at
+        flux: flux observed
+        var: flux variance
+        smoothed_wave: wavelengths to evaluate the spline at
+
+    Returns:
+        smoothed_flux: spline evaluated along smoothed_wave
+    """
+    w = 1.0 / np.sqrt(var)
+    spl = US(wave, flux, w=w)
+    smoothed_flux = spl(smoothed_wave)
+    return smoothed_flux
+
+
 class Spectrum(object):
     def __init__(self, wave, flux, var, smooth_type="spl"):
         """
@@ -93,10 +112,7 @@ class Spectrum(object):
         Returns:
             smoothed_flux: spline evaluated along smoothed_wave
         """
-        w = 1.0 / np.sqrt(self.var)
-        spl = US(self.wave, self.flux, w=w)
-        smoothed_flux = spl(self.smoothed_wave)
-        return smoothed_flux
+        return spline_smooth(self.wave, self.flux, self.var, self.smoothed_wave)
 
     def gauss_filt(self, smooth_fac=0.02, n_l=15):
         """
@@ -279,6 +295,92 @@ class Spectrum(object):
                 self._EWCaIIHK = np.nan
         return self._EWCaIIHK
 
+    @staticmethod
+    def get_spin_dict_batch(wave, flux, var):
+        """
+        Get the available spectral indicators for a set of spectra at once
+
+        All of the spectra must share the same wavelengths. Each spectrum is smoothed
+        individually, but the extrema and equivalent widths are then measured on the
+        full stack of smoothed spectra at once. The smoothed spectra are only
+        evaluated in the wavelength windows around the features rather than on the
+        full 0.1 A grid to keep the stack small.
+
+        Args:
+            wave: wavelength the spectra are observed at
+            flux: 2D array of the observed flux for each spectrum
+            var: 2D array of the flux variance for each spectrum
+
+        Returns:
+            spin_dict: dictionary with an array of each spectral indicator
+        """
+        smoothed_wave = np.arange(min(wave), max(wave), 0.1)
+
+        # Only keep the points of the smoothed grid that fall in one of the feature
+        # windows.
+        feature_mask = np.zeros(len(smoothed_wave), dtype=bool)
+        for limit in LIMITS.values():
+            feature_mask |= (limit[0] <= smoothed_wave) & (smoothed_wave <= limit[3])
+        smoothed_wave = smoothed_wave[feature_mask]
+
+        smoothed_flux = np.array([
+            spline_smooth(wave, spec_flux, spec_var, smoothed_wave)
+            for spec_flux, spec_var in zip(flux, var)
+        ])
+
+        lam = {}
+        ew = {}
+        for feature_name, limit in LIMITS.items():
+            # Only work with the region of the spectrum around this feature. The
+            # window is contiguous, so use a slice to get views rather than copies.
+            window = slice(np.searchsorted(smoothed_wave, limit[0], side='left'),
+                           np.searchsorted(smoothed_wave, limit[3], side='right'))
+            window_wave = smoothed_wave[window]
+            window_flux = smoothed_flux[:, window]
+
+            l_ind = np.where(window_wave < limit[1])[0]
+            r_ind = np.where(limit[2] <= window_wave)[0]
+            c_ind = np.where((limit[1] <= window_wave) & (window_wave < limit[2]))[0]
+            if len(l_ind) == 0 or len(r_ind) == 0 or len(c_ind) == 0:
+                raise ValueError
+
+            l_max_ind = l_ind[np.argmax(window_flux[:, l_ind], axis=1)]
+            r_max_ind = r_ind[np.argmax(window_flux[:, r_ind], axis=1)]
+
+            # Pseudo continuum subtracted flux for every spectrum.
+            rows = np.arange(len(window_flux))
+            l_flux = window_flux[rows, l_max_ind]
+            r_flux = window_flux[rows, r_max_ind]
+            pseudo_cont_slope = (
+                (r_flux - l_flux) / (window_wave[r_max_ind] - window_wave[l_max_ind])
+            )
+            pseudo_cont_int = r_flux - pseudo_cont_slope * window_wave[r_max_ind]
+            pc_sub_flux = window_flux / (
+                pseudo_cont_slope[:, None] * window_wave + pseudo_cont_int[:, None]
+            )
+
+            c_min_ind = c_ind[np.argmin(pc_sub_flux[:, c_ind], axis=1)]
+            lam[feature_name] = window_wave[c_min_ind]
+
+            feature_ind = np.arange(len(window_wave))
+            feature_mask = (
+                (feature_ind >= l_max_ind[:, None])
+                & (feature_ind < r_max_ind[:, None])
+            )
+            ew[feature_name] = np.sum((1.0 - pc_sub_flux) * feature_mask, axis=1) * 0.1
+
+        spin_dict = {
+            "lamSiII6355": lam["SiII6355"],
+            "lamCaIIHK": lam["CaIIHK"],
+            "vSiII6355": vel_space(lam["SiII6355"], 6355.0),
+            "vCaIIHK": vel_space(lam["CaIIHK"], 3934.0),
+            "EWSiII4000": ew["SiII4000"],
+            "EWSiII5972": ew["SiII5972"],
+            "EWSiII6355": ew["SiII6355"],
+            "EWCaIIHK": ew["CaIIHK"],
+        }
+        return spin_dict
+
     def get_spin_dict(self):
         """
         Get a dictionary with the available spectral indicators
@@ -1,10 +1,10 @@
 from astropy import table
-from hashlib import md5
 from idrtools import Dataset, math
 from matplotlib import pyplot as plt
 from matplotlib.colors import ListedColormap
 from matplotlib.gridspec import GridSpec
-from scipy.optimize import minimize
+from operator import attrgetter, itemgetter
+from scipy.optimize import brentq, minimize
 from sklearn.manifold import Isomap
 import extinction
 import numpy as np
@@ -30,6 +30,12 @@ class TwinsEmbeddingAnalysis:
         # Update the default settings with any arguments that came in from kwargs.
         self.settings = dict(default_settings, **kwargs)
 
+        # Cache of fitted Isomap models, see generate_embedding.
+        self._isomap_cache = {}
+
+        # Cache of distances between spectra, see calculate_spectral_distances.
+        self._spectral_distance_cache = {}
+
         # Set the default matplotlib figure size from the settings.
         import matplotlib as mpl
         for key, value in self.settings['matplotlib_settings'].items():
@@ -47,8 +53,8 @@ class TwinsEmbeddingAnalysis:
             # interpolation.
             self.print_verbose("TEST: Using the spectra closest to maximum light "
                                "directly, without the time evolution model...")
-            self.maximum_flux = self.flux[self.center_mask]
-            self.maximum_fluxerr = self.fluxerr[self.center_mask]
+            self.maximum_flux = self.flux[self.center_idx]
+            self.maximum_fluxerr = self.fluxerr[self.center_idx]
 
         self.print_verbose("Reading between the lines...")
         self.read_between_the_lines()
@@ -147,47 +153,57 @@ class TwinsEmbeddingAnalysis:
                 target_center_mask[np.argmin(np.abs(used_phases))] = True
                 center_mask.extend(target_center_mask)
 
-        all_flux = []
-        all_fluxerr = []
-        all_spec = []
-
-        for spectrum in all_raw_spec:
-            bin_spec = spectrum.bin_by_velocity(
-                self.settings['bin_velocity'],
-                self.settings['bin_min_wavelength'],
-                self.settings['bin_max_wavelength'],
-            )
-            all_flux.append(bin_spec.flux)
-            all_fluxerr.append(bin_spec.fluxerr)
-            all_spec.append(bin_spec)
+        # Bin all of the spectra onto a common grid. Each raw spectrum has its own
+        # restframe wavelength grid, so there is no single rebinning matrix that we
+        # could apply to all of them at once.
+        bin_arguments = (
+            self.settings['bin_velocity'],
+            self.settings['bin_min_wavelength'],
+            self.settings['bin_max_wavelength'],
+        )
+        all_spec = [spectrum.bin_by_velocity(*bin_arguments)
+                    for spectrum in all_raw_spec]
 
         # All binned spectra have the same wavelengths, so save the wavelengths
         # from an arbitrary one of them.
         self.wave = all_spec[0].wave
 
-        # Save the rest of the info
-        self.flux = np.array(all_flux)
-        self.fluxerr = np.array(all_fluxerr)
+        # Fill in the fluxes of all of the binned spectra. The spectra are noise limited
+        # far above single precision, so we store the fluxes as float32 to halve their
+        # memory footprint. They are converted back to float64 before being passed to
+        # Stan.
+        self.flux = np.empty((len(all_spec), len(self.wave)), dtype=np.float32)
+        self.fluxerr = np.empty_like(self.flux)
+        for idx, bin_spec in enumerate(all_spec):
+            self.flux[idx] = bin_spec.flux
+            self.fluxerr[idx] = bin_spec.fluxerr
+
+        # Save the rest of the info.
         self.raw_spectra = np.array(all_raw_spec)
         self.spectra = np.array(all_spec)
         self.center_mask = np.array(center_mask)
+        self.center_idx = np.where(self.center_mask)[0]
+
+        # Build a list of targets and a map from spectra to targets. We deduplicate the
+        # targets with a dict and then only sort the unique targets rather than the
+        # target of every spectrum. This gives the same sorted order as np.unique.
+        spectra_targets = [i.target for i in self.spectra]
+        self.targets = np.array(sorted(dict.fromkeys(spectra_targets)))
+        target_indices = {target: idx for idx, target in enumerate(self.targets)}
+        self.target_map = np.fromiter((target_indices[i] for i in spectra_targets),
+                                      dtype=int, count=len(spectra_targets))
 
         # Pull out variables that we use all the time.
         self.helio_redshifts = self.read_meta("host.zhelio")
         self.redshifts = self.read_meta("host.zcmb")
         self.redshift_errs = self.read_meta("host.zhelio.err")
 
-        # Build a list of targets and a map from spectra to targets.
-        self.targets = np.unique([i.target for i in self.spectra])
-        self.target_map = np.array(
-            [self.targets.tolist().index(i.target) for i in self.spectra]
-        )
-
         # Pull out SALT fit info
         self.salt_fits = table.Table([i.salt_fit for i in self.targets])
         self.salt_x1 = self.salt_fits['x1'].data
         self.salt_colors = self.salt_fits['c'].data
-        self.salt_phases = np.array([i.phase for i in self.spectra])
+        self.salt_phases = np.fromiter((i.phase for i in self.spectra), dtype=float,
+                                       count=len(self.spectra))
         self.salt_mask = np.array([i.has_valid_salt_fit() for i in self.targets])
 
         # Record which targets should be in the validation set.
@@ -196,17 +212,16 @@ class TwinsEmbeddingAnalysis:
         )
 
         # Build a hash that is unique to the dataset that we are working on.
-        hash_info = (
-            self.settings['idr']
-            + ';' + str(self.settings['phase_range'])
-            + ';' + str(self.settings['bin_velocity'])
-            + ';' + str(self.settings['bin_min_wavelength'])
-            + ';' + str(self.settings['bin_max_wavelength'])
-            + ';' + str(self.settings['s2n_cut_min_wavelength'])
-            + ';' + str(self.settings['s2n_cut_max_wavelength'])
-            + ';' + str(self.settings['s2n_cut_threshold'])
+        self.dataset_hash = utils.calculate_hash(
+            self.settings['idr'],
+            self.settings['phase_range'],
+            self.settings['bin_velocity'],
+            self.settings['bin_min_wavelength'],
+            self.settings['bin_max_wavelength'],
+            self.settings['s2n_cut_min_wavelength'],
+            self.settings['s2n_cut_max_wavelength'],
+            self.settings['s2n_cut_threshold'],
         )
-        self.dataset_hash = md5(hash_info.encode("ascii")).hexdigest()
 
         # Load a dictionary that maps IDR names into IAU ones.
         iau_data = np.genfromtxt('./data/iau_name_map.txt', dtype=str)
@@ -257,19 +272,18 @@ class TwinsEmbeddingAnalysis:
             raise KeyError("Couldn't find key %s in metadata." % key)
 
         if center_only:
-            use_spectra = self.spectra[self.center_mask]
+            use_spectra = self.spectra[self.center_idx]
         else:
             use_spectra = self.spectra
 
-        res = []
-        for spec in use_spectra:
-            if read_spectrum:
-                val = spec.meta[key]
-            else:
-                val = spec.target.meta[key]
-            res.append(val)
+        # Pull the meta dict off of each spectrum or target, and then look up the key
+        # in each of them. This raises a KeyError if any of them is missing the key.
+        if read_spectrum:
+            get_meta = attrgetter('meta')
+        else:
+            get_meta = attrgetter('target.meta')
 
-        res = np.array(res)
+        res = np.array(list(map(itemgetter(key), map(get_meta, use_spectra))))
 
         return res
 
@@ -306,13 +320,12 @@ class TwinsEmbeddingAnalysis:
         )
 
         # Build a hash that is unique to this dataset/analysis
-        hash_info = (
-            self.dataset_hash
-            + ';' + model_hash
-            + ';' + str(self.settings['differential_evolution_num_phase_coefficients'])
-            + ';' + str(self.settings['differential_evolution_use_salt_x1'])
+        self.differential_evolution_hash = utils.calculate_hash(
+            self.dataset_hash,
+            model_hash,
+            self.settings['differential_evolution_num_phase_coefficients'],
+            self.settings['differential_evolution_use_salt_x1'],
         )
-        self.differential_evolution_hash = md5(hash_info.encode("ascii")).hexdigest()
 
         # If we ran this model before, read the cached result if we can.
         if use_cache:
@@ -334,33 +347,48 @@ class TwinsEmbeddingAnalysis:
         if num_phase_coefficients % 2 != 0:
             raise Exception("ERROR: Must have an even number of phase " "coefficients.")
 
-        spectra_targets = [i.target for i in self.spectra]
-        spectra_target_counts = np.array(
-            [spectra_targets.count(i.target) for i in self.spectra]
+        # Count how many spectra each target has, and map it back to the spectra.
+        _, target_inverse, target_counts = np.unique(
+            self.target_map, return_inverse=True, return_counts=True
         )
+        spectra_target_counts = target_counts[target_inverse]
+
+        # Figure out the weight of each phase coefficient for every spectrum. Each
+        # spectrum gets a weight of 1 for every bin between maximum light and its
+        # phase, and a fractional weight for the bin that its phase lies in. This is
+        # done for all spectra at once rather than looping over them.
+        phase_scale = np.abs(
+            (num_phase_coefficients / 2)
+            * (self.salt_phases / self.settings['phase_range'])
+        )
+        full_bins = np.floor(phase_scale).astype(int)
+        remainder = phase_scale - full_bins
 
-        phase_coefficients = np.zeros((num_spectra, num_phase_coefficients))
-
-        for i, phase in enumerate(self.salt_phases):
-            phase_scale = np.abs(
-                (num_phase_coefficients / 2) * (phase / self.settings['phase_range'])
-            )
+        positive_phase = self.salt_phases > 0
+        phase_sign = np.where(positive_phase, 1, -1)
+        phase_base = np.where(
+            positive_phase,
+            num_phase_coefficients // 2,
+            num_phase_coefficients // 2 - 1
+        )
 
-            full_bins = int(np.floor(phase_scale))
-            remainder = phase_scale - full_bins
+        bin_offsets = np.arange(num_phase_coefficients // 2 + 1)[None, :]
+        phase_bins = phase_base[:, None] + phase_sign[:, None] * bin_offsets
+        weights = np.where(bin_offsets == full_bins[:, None], remainder[:, None], 1.)
 
-            for j in range(full_bins + 1):
-                if j == full_bins:
-                    weight = remainder
-                else:
-                    weight = 1
+        # Skip bins beyond the phase of each spectrum and bins with no weight. The
+        # latter can otherwise fall off the edge of the grid for spectra exactly at
+        # the edge of the phase range.
+        bin_mask = (bin_offsets <= full_bins[:, None]) & (weights > 0)
+        spectrum_idx = np.broadcast_to(np.arange(num_spectra)[:, None],
+                                       phase_bins.shape)
 
-                if phase > 0:
-                    phase_bin = num_phase_coefficients // 2 + j
-                else:
-                    phase_bin = num_phase_coefficients // 2 - 1 - j
-
-                phase_coefficients[i, phase_bin] = weight
+        phase_coefficients = np.zeros((num_spectra, num_phase_coefficients))
+        np.add.at(
+            phase_coefficients,
+            (spectrum_idx[bin_mask], phase_bins[bin_mask]),
+            weights[bin_mask]
+        )
 
         def stan_init():
             init_params = {
@@ -386,14 +414,14 @@ class TwinsEmbeddingAnalysis:
             "num_targets": num_targets,
             "num_spectra": num_spectra,
             "num_wave": num_wave,
-            "measured_flux": self.flux,
-            "measured_fluxerr": self.fluxerr,
-            "phases": [i.phase for i in self.spectra],
+            "measured_flux": self.flux.astype(np.float64),
+            "measured_fluxerr": self.fluxerr.astype(np.float64),
+            "phases": self.salt_phases,
             "phase_coefficients": phase_coefficients,
             "num_phase_coefficients": num_phase_coefficients,
             "spectra_target_counts": spectra_target_counts,
             "target_map": self.target_map + 1,  # stan uses 1-based indexing
-            "maximum_map": np.where(self.center_mask)[0] + 1,
+            "maximum_map": self.center_idx + 1,
             "salt_x1": x1,
         }
 
@@ -418,8 +446,8 @@ class TwinsEmbeddingAnalysis:
         The fit is performed using Stan. We only use Stan as a minimizer here.
         """
         # Load the fiducial color law.
-        self.rbtl_color_law = extinction.fitzpatrick99(
-            self.wave, 1.0, self.settings['rbtl_fiducial_rv']
+        self.rbtl_color_law = utils.calculate_color_law(
+            self.wave, self.settings['rbtl_fiducial_rv']
         )
 
         # Load the stan model
@@ -430,14 +458,14 @@ class TwinsEmbeddingAnalysis:
         )
 
         # Build a hash that is unique to this dataset/analysis
-        hash_info = (
-            self.differential_evolution_hash
-            + ';' + model_hash
-            + ';' + str(self.settings['rbtl_fiducial_rv'])
-        )
+        hash_components = [
+            self.differential_evolution_hash,
+            model_hash,
+            self.settings['rbtl_fiducial_rv'],
+        ]
         if self.settings['test_no_interpolation']:
-            hash_info += ';no_interpolation'
-        self.rbtl_hash = md5(hash_info.encode("ascii")).hexdigest()
+            hash_components.append('no_interpolation')
+        self.rbtl_hash = utils.calculate_hash(*hash_components)
 
         # If we ran this model before, read the cached result if we can.
         if use_cache:
@@ -468,8 +496,8 @@ class TwinsEmbeddingAnalysis:
         stan_data = {
             "num_targets": num_targets,
             "num_wave": num_wave,
-            "maximum_flux": self.maximum_flux,
-            "maximum_fluxerr": self.maximum_fluxerr,
+            "maximum_flux": np.asarray(self.maximum_flux, dtype=np.float64),
+            "maximum_fluxerr": np.asarray(self.maximum_fluxerr, dtype=np.float64),
             "color_law": self.rbtl_color_law,
         }
 
@@ -532,14 +560,59 @@ class TwinsEmbeddingAnalysis:
             self.rbtl_mags[~self.train_mask] = np.nan
 
         # Deredden the real spectra and set them to the same scale as the mean
-        # spectrum.
-        self.scale_flux = self.maximum_flux / result['model_scales']
+        # spectrum. The uncertainties are kept in float64 since they get squared
+        # downstream.
+        self.scale_flux = (
+            self.maximum_flux / result['model_scales']
+        ).astype(np.float32)
         self.scale_fluxerr = self.maximum_fluxerr / result['model_scales']
 
-        # Calculate fractional differences from the mean spectrum.
-        self.fractional_differences = self.scale_flux / self.mean_flux - 1
+        # Calculate fractional differences from the mean spectrum. This is done in
+        # place to avoid allocating an extra temporary array.
+        self.fractional_differences = np.divide(self.scale_flux, self.mean_flux,
+                                                dtype=np.float32)
+        self.fractional_differences -= 1
         self.fractional_difference_uncertainties = self.scale_fluxerr / self.mean_flux
 
+        # The fractional differences changed, so drop any cached distances.
+        self._spectral_distance_cache = {}
+
+    def calculate_spectral_distances(self, mask=None):
+        """Calculate the distances between the fractional differences of each pair of
+        spectra.
+
+        The distances are cached for each mask since several of the twin analyses use
+        the same ones.
+
+        Parameters
+        ----------
+        mask : numpy.array, optional
+            Mask to select the spectra to use. By default, all spectra are used.
+
+        Returns
+        -------
+        spectral_distances : numpy.array
+            The condensed distance matrix in the same format as
+            `scipy.spatial.distance.pdist`. This array is shared with the cache, so it
+            is read-only.
+        """
+        if mask is None:
+            mask = np.ones(len(self.fractional_differences), dtype=bool)
+        else:
+            mask = np.asarray(mask, dtype=bool)
+
+        cache_key = mask.tobytes()
+        spectral_distances = self._spectral_distance_cache.get(cache_key)
+
+        if spectral_distances is None:
+            spectral_distances = utils.calculate_pairwise_distances(
+                self.fractional_differences[mask]
+            )
+            spectral_distances.flags.writeable = False
+            self._spectral_distance_cache[cache_key] = spectral_distances
+
+        return spectral_distances
+
     def build_masks(self):
         """Build masks that are used in the various manifold learning and magnitude
         analyses
@@ -551,11 +624,11 @@ class TwinsEmbeddingAnalysis:
         intrinsic_dispersion = utils.frac_to_mag(
             self.rbtl_result["fractional_dispersion"]
         )
-        intrinsic_power = np.sum(intrinsic_dispersion**2)
+        intrinsic_power = intrinsic_dispersion.dot(intrinsic_dispersion)
         maximum_uncertainty = utils.frac_to_mag(
             self.maximum_fluxerr / self.maximum_flux
         )
-        maximum_power = np.sum(maximum_uncertainty**2, axis=1)
+        maximum_power = np.einsum('ij,ij->i', maximum_uncertainty, maximum_uncertainty)
         self.maximum_uncertainty_fraction = maximum_power / intrinsic_power
         self.uncertainty_mask = (
             self.maximum_uncertainty_fraction <
@@ -584,7 +657,21 @@ class TwinsEmbeddingAnalysis:
         By default we use Isomap with hyperparameters as set in the settings, but
         this can be overridden by manually specifying any model that follows the
         sklearn API or hyperparameters.
+
+        Isomap models are cached, so calling this function again with the same data
+        and hyperparameters will not redo the neighbor search and shortest path
+        calculations.
         """
+        if mask is None:
+            good_mask = self.uncertainty_mask
+        else:
+            good_mask = mask
+
+        if data is None:
+            data = self.fractional_differences
+
+        fit_data = data[good_mask]
+
         if model is None:
             if num_neighbors is None:
                 num_neighbors = self.settings['isomap_num_neighbors']
@@ -592,18 +679,30 @@ class TwinsEmbeddingAnalysis:
             if num_components == -1:
                 num_components = self.settings['isomap_num_components']
 
-            model = Isomap(n_neighbors=num_neighbors, n_components=num_components)
-
-        if mask is None:
-            good_mask = self.uncertainty_mask
-        else:
-            good_mask = mask
+            eigen_solver = self.settings['isomap_eigen_solver']
 
-        if data is None:
-            data = self.fractional_differences
+            cache_key = utils.calculate_hash(
+                utils.calculate_array_hash(fit_data),
+                num_neighbors,
+                num_components,
+                eigen_solver,
+            )
+            model = self._isomap_cache.get(cache_key)
+
+            if model is None:
+                # Build the embedding using well-measured targets
+                model = Isomap(
+                    n_neighbors=num_neighbors,
+                    n_components=num_components,
+                    eigen_solver=eigen_solver,
+                )
+                model.fit(fit_data)
+                self._isomap_cache[cache_key] = model
 
-        # Build the embedding using well-measured targets
-        ref_embedding = model.fit_transform(data[good_mask])
+            ref_embedding = model.embedding_
+        else:
+            # Build the embedding using well-measured targets
+            ref_embedding = model.fit_transform(fit_data)
 
         # Evaluate the coordinates in the embedding for the remaining targets.
         if not np.all(good_mask):
@@ -675,15 +774,9 @@ class TwinsEmbeddingAnalysis:
 
     def calculate_spectral_indicators(self):
         """Calculate spectral indicators for all of the features"""
-        spectral_indicators = []
-
-        for idx in range(len(self.scale_flux)):
-            spec = specind.Spectrum(
-                self.wave, self.scale_flux[idx], self.scale_fluxerr[idx]**2
-            )
-            indicators = spec.get_spin_dict()
-            spectral_indicators.append(indicators)
-
+        spectral_indicators = specind.Spectrum.get_spin_dict_batch(
+            self.wave, self.scale_flux, self.scale_fluxerr**2
+        )
         spectral_indicators = table.Table(spectral_indicators, masked=True)
 
         # Figure out Branch classifications
@@ -718,11 +811,22 @@ class TwinsEmbeddingAnalysis:
         # Read the table
         data = table.Table.read(path)
 
-        # Make a dummy table with the names of each of our SNe~Ia
-        name_table = table.Table({name_key: [i.name for i in self.targets]})
+        # Find the row of the table for each of our SNe~Ia with a dictionary lookup.
+        # Targets that aren't in the table are masked out.
+        name_to_index = {name: index for index, name in enumerate(data[name_key])}
+        target_names = [i.name for i in self.targets]
+        target_indices = np.array([name_to_index.get(i, -1) for i in target_names])
+        missing_mask = target_indices < 0
+
+        ordered_table = table.Table(data[np.where(missing_mask, 0, target_indices)],
+                                    masked=True)
+        for column in ordered_table.itercols():
+            column.mask |= missing_mask
 
-        # Join the tables
-        ordered_table = table.join(name_table, data, join_type='left')
+        # Use our names for the key column so that it is defined for every target, and
+        # put it first like a join would.
+        del ordered_table[name_key]
+        ordered_table.add_column(table.Column(target_names, name=name_key), index=0)
 
         return ordered_table
 
@@ -1030,13 +1134,68 @@ class TwinsEmbeddingAnalysis:
             mask,
         )
 
-        manifold_gp.fit(verbosity=verbosity)
+        manifold_gp.fit(
+            verbosity=verbosity,
+            num_restarts=self.settings['gp_num_restarts'],
+            n_jobs=self.settings['gp_num_jobs'],
+        )
 
         return manifold_gp
 
+    def _get_salt_magnitude_data(self, additional_covariates, mask=None):
+        """Collect the SALT2 quantities needed to evaluate magnitude residuals.
+
+        None of these depend on the standardization parameters, so they can be
+        calculated once and reused when fitting for those parameters.
+
+        Parameters
+        ----------
+        additional_covariates : list of arrays
+            Additional covariates to use in the fits (e.g. host properties). This should
+            be a list of arrays, each of which has the same length as the number of
+            SNe Ia in the dataset.
+        mask : numpy.array, optional
+            Mask or indices to select the targets to use. By default, every target in
+            the dataset is used.
+
+        Returns
+        -------
+        salt_data : dict
+            Dictionary with the SALT2 magnitudes, parameters, uncertainties and
+            covariances, the peculiar velocity uncertainties and the additional
+            covariates for the selected targets.
+        """
+        if mask is None:
+            mask = slice(None)
+
+        salt_fits = self.salt_fits
+
+        x0 = salt_fits['x0'].data[mask]
+        x0_err = salt_fits['x0_err'].data[mask]
+        mb_err = utils.frac_to_mag(x0_err / x0)
+        covariance = salt_fits['covariance'].data[mask]
+
+        peculiar_velocity_uncertainties = \
+            self.calculate_peculiar_velocity_uncertainties(self.redshifts[mask])
+
+        salt_data = {
+            'mb': -2.5*np.log10(x0),
+            'x1': salt_fits['x1'].data[mask],
+            'color': salt_fits['c'].data[mask],
+            'base_variance': peculiar_velocity_uncertainties**2 + mb_err**2,
+            'x1_variance': salt_fits['x1_err'].data[mask]**2,
+            'color_variance': salt_fits['c_err'].data[mask]**2,
+            'cov_mb_x1': covariance[:, 1, 2] * -mb_err / x0_err,
+            'cov_color_mb': covariance[:, 1, 3] * -mb_err / x0_err,
+            'cov_color_x1': covariance[:, 2, 3],
+            'additional_covariates': [i[mask] for i in additional_covariates],
+        }
+
+        return salt_data
+
     def _evaluate_salt_magnitude_residuals(self, additional_covariates,
                                            intrinsic_dispersion, ref_mag, alpha, beta,
-                                           *covariate_slopes):
+                                           *covariate_slopes, salt_data=None):
         """Evaluate SALT2 magnitude residuals for a given set of standardization
         parameters
 
@@ -1056,6 +1215,10 @@ class TwinsEmbeddingAnalysis:
             Standardization coefficient for the SALT2 color parameter
         covariate_slopes : list
             Slopes for each of the additional covariates.
+        salt_data : dict, optional
+            Precomputed output of `_get_salt_magnitude_data`. If this is specified,
+            the residuals are only evaluated for the targets that were selected when
+            it was computed, and additional_covariates is ignored.
 
         Returns
         -------
@@ -1064,42 +1227,30 @@ class TwinsEmbeddingAnalysis:
         residual_uncertainties : numpy.array
             The associated uncertainties on the SALT2 magnitude residuals.
         """
-        salt_fits = self.salt_fits
-
-        mb = -2.5*np.log10(salt_fits['x0'].data)
-        x0_err = salt_fits['x0_err'].data
-        mb_err = utils.frac_to_mag(x0_err / salt_fits['x0'].data)
-        x1_err = salt_fits['x1_err'].data
-        color_err = salt_fits['c_err'].data
-
-        cov_mb_x1 = salt_fits['covariance'].data[:, 1, 2] * -mb_err / x0_err
-        cov_color_mb = salt_fits['covariance'].data[:, 1, 3] * -mb_err / x0_err
-        cov_color_x1 = salt_fits['covariance'].data[:, 2, 3]
-
-        peculiar_velocity_uncertainties = \
-            self.calculate_peculiar_velocity_uncertainties(self.redshifts)
+        if salt_data is None:
+            salt_data = self._get_salt_magnitude_data(additional_covariates)
 
         model = (
             ref_mag
-            - alpha * salt_fits['x1'].data
-            + beta * salt_fits['c'].data
+            - alpha * salt_data['x1']
+            + beta * salt_data['color']
         )
 
-        for slope, covariate in zip(covariate_slopes, additional_covariates):
+        for slope, covariate in zip(covariate_slopes,
+                                    salt_data['additional_covariates']):
             model += slope * covariate
 
         residual_uncertainties = np.sqrt(
             intrinsic_dispersion**2
-            + peculiar_velocity_uncertainties**2
-            + mb_err**2
-            + alpha**2 * x1_err**2
-            + beta**2 * color_err**2
-            + 2 * alpha * cov_mb_x1
-            - 2 * beta * cov_color_mb
-            - 2 * alpha * beta * cov_color_x1
+            + salt_data['base_variance']
+            + alpha**2 * salt_data['x1_variance']
+            + beta**2 * salt_data['color_variance']
+            + 2 * alpha * salt_data['cov_mb_x1']
+            - 2 * beta * salt_data['cov_color_mb']
+            - 2 * alpha * beta * salt_data['cov_color_x1']
         )
 
-        residuals = mb - model
+        residuals = salt_data['mb'] - model
 
         return residuals, residual_uncertainties
 
@@ -1138,18 +1289,26 @@ class TwinsEmbeddingAnalysis:
             # uncertainties on all of our parameters.
             mask = np.random.choice(np.where(mask)[0], np.sum(mask))
 
+        # Gather the SALT2 data for the fit sample. This doesn't depend on any of the
+        # parameters, so we only need to do it once.
+        fit_salt_data = self._get_salt_magnitude_data(additional_covariates, mask)
+
         # Starting value for intrinsic dispersion. We will update this in each
         # round to set chi2 = 1
         intrinsic_dispersion = 0.1
 
+        # Starting values for the standardization parameters. After the first pass,
+        # we start from the previous solution which only changes slightly as the
+        # intrinsic dispersion converges.
+        start_vals = [-10, 0.13, 3.0] + [0.] * len(additional_covariates)
+
         for i in range(10):
             def calc_dispersion(*fit_parameters):
-                residuals, residual_uncertainties = \
-                    self._evaluate_salt_magnitude_residuals(additional_covariates,
-                                                            *fit_parameters)
-
-                mask_residuals = residuals[mask]
-                mask_residual_uncertainties = residual_uncertainties[mask]
+                mask_residuals, mask_residual_uncertainties = \
+                    self._evaluate_salt_magnitude_residuals(
+                        additional_covariates, *fit_parameters,
+                        salt_data=fit_salt_data
+                    )
 
                 weights = 1 / mask_residual_uncertainties**2
 
@@ -1163,10 +1322,9 @@ class TwinsEmbeddingAnalysis:
             def to_min_fit_parameters(x):
                 return calc_dispersion(intrinsic_dispersion, *x)
 
-            start_vals = [-10, 0.13, 3.0] + [0.] * len(additional_covariates)
-
             res = minimize(to_min_fit_parameters, start_vals)
             fit_parameters = res.x
+            start_vals = fit_parameters
 
             if verbosity >= 2:
                 print(f"Pass {i}, ref_mag={fit_parameters[0]:.3f}, "
@@ -1175,32 +1333,38 @@ class TwinsEmbeddingAnalysis:
 
             # Reestimate intrinsic dispersion.
             def chisq(intrinsic_dispersion):
-                residuals, residual_uncertainties = \
+                mask_residuals, mask_residual_uncertainties = \
                     self._evaluate_salt_magnitude_residuals(
-                        additional_covariates, intrinsic_dispersion, *res.x
+                        additional_covariates, intrinsic_dispersion, *res.x,
+                        salt_data=fit_salt_data
                     )
 
-                mask_residuals = residuals[mask]
-                mask_residual_uncertainties = residual_uncertainties[mask]
-
                 dof = 4 + len(additional_covariates)
 
                 return np.sum(
                     mask_residuals**2 / mask_residual_uncertainties**2
                 ) / (len(mask_residuals) - dof)
 
-            def to_min_intrinsic_dispersion(x):
-                chi2 = chisq(x[0])
-                return (chi2 - 1)**2
-
-            res_int_disp = minimize(
-                to_min_intrinsic_dispersion,
-                [intrinsic_dispersion],
-                bounds=[(0, None)],
-            )
+            def to_root_intrinsic_dispersion(intrinsic_dispersion):
+                return chisq(intrinsic_dispersion) - 1
 
             old_intrinsic_dispersion = intrinsic_dispersion
-            intrinsic_dispersion = res_int_disp.x[0]
+
+            # The chi-square decreases monotonically with the intrinsic dispersion.
+            # If the measurement uncertainties alone already give a chi-square below
+            # 1, then the intrinsic dispersion is 0. Otherwise, bracket the root and
+            # solve for it.
+            if to_root_intrinsic_dispersion(0.) <= 0:
+                intrinsic_dispersion = 0.
+            else:
+                max_intrinsic_dispersion = max(2 * old_intrinsic_dispersion, 0.1)
+                while to_root_intrinsic_dispersion(max_intrinsic_dispersion) > 0:
+                    max_intrinsic_dispersion *= 2
+
+                intrinsic_dispersion = brentq(
+                    to_root_intrinsic_dispersion, 0., max_intrinsic_dispersion,
+                    xtol=1e-8,
+                )
 
             if verbosity >= 2:
                 print("  -> new intrinsic_dispersion=%.3f" % intrinsic_dispersion)
@@ -1,6 +1,8 @@
 """Utility functions for the Manifold learning analysis"""
 
-from hashlib import md5
+from functools import lru_cache
+from hashlib import blake2b, md5
+import extinction
 import os
 import numpy as np
 import pickle
@@ -51,6 +53,43 @@ def load_stan_model(path, *args, **kwargs):
     return compile_stan_model(model_code, *args, **kwargs)
 
 
+def calculate_hash(*components):
+    """Calculate a hash that can be used as a key to cache results.
+
+    Each component is converted to a string, and the components are joined together
+    before hashing. This is only used to key caches, so we use blake2b which is faster
+    than md5. The digest has the same length as an md5 one.
+    """
+    hash_info = ';'.join(str(i) for i in components)
+    return blake2b(hash_info.encode("ascii"), digest_size=16).hexdigest()
+
+
+def calculate_array_hash(array):
+    """Calculate a hash of the contents of a numpy array."""
+    array = np.ascontiguousarray(array)
+    hash_info = str(array.dtype).encode("ascii") + str(array.shape).encode("ascii")
+    return blake2b(hash_info + array.tobytes(), digest_size=16).hexdigest()
+
+
+def calculate_pairwise_distances(x):
+    """Calculate the Euclidean distances between each pair of rows of an array.
+
+    This returns the same condensed distance matrix as `scipy.spatial.distance.pdist`,
+    but the distances are calculated as ||x_i||^2 + ||x_j||^2 - 2 x_i.x_j with a
+    single matrix product. This is much faster than pdist for arrays with many
+    columns such as spectra.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    norms = np.einsum('ij,ij->i', x, x)
+    squared_distances = norms[:, None] + norms[None, :] - 2 * x.dot(x.T)
+
+    # Roundoff can give slightly negative values for nearly identical rows.
+    np.maximum(squared_distances, 0, out=squared_distances)
+
+    upper_indices = np.triu_indices(len(x), 1)
+    return np.sqrt(squared_distances[upper_indices])
+
+
 def save_stan_result(hash_str, result, cache_dir='./stan_cache'):
     """Save the result of a Stan model to a pickle file
 
@@ -86,6 +125,28 @@ def load_stan_result(hash_str, cache_dir='./stan_cache'):
     return None
 
 
+@lru_cache(maxsize=8)
+def _calculate_color_law_cached(wave_bytes, wave_dtype, rv):
+    wave = np.frombuffer(wave_bytes, dtype=wave_dtype).copy()
+    color_law = extinction.fitzpatrick99(wave, 1.0, rv)
+
+    # The same array is returned for every call, so make sure that it can't be
+    # modified.
+    color_law.setflags(write=False)
+
+    return color_law
+
+
+def calculate_color_law(wave, rv):
+    """Calculate the Fitzpatrick 1999 color law normalized to A_V = 1.
+
+    The result is cached since we evaluate this repeatedly for the same wavelengths.
+    The returned array is read-only.
+    """
+    wave = np.ascontiguousarray(wave, dtype=np.float64)
+    return _calculate_color_law_cached(wave.tobytes(), wave.dtype.str, rv)
+
+
 def frac_to_mag(fractional_difference):
     """Convert a fractional difference to a difference in magnitude
 